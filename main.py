@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import aiohttp
 import re
@@ -5,12 +6,21 @@ import yaml
 import json
 import os
 import shutil
+import posixpath
+import numpy as np
+from scipy import sparse
 from pathlib import Path
+from urllib.parse import urljoin
 
 # URLs
 ROLES_REFERENCE_URL = 'https://raw.githubusercontent.com/yandex-cloud/docs/refs/heads/master/ru/iam/roles-reference.md'
 PRESETS_YAML_URL = 'https://raw.githubusercontent.com/yandex-cloud/docs/refs/heads/master/ru/presets.yaml'
-ROLES_PRIMITIVE = 'https://raw.githubusercontent.com/yandex-cloud/docs/refs/heads/master/ru/_includes/roles-primitive.md'
+
+# Журнал загруженных описаний ролей для --resume
+FETCH_JOURNAL = '.roles-journal.jsonl'
+
+# Описание роли, файл которой не найден или пуст
+MISSING_DESCRIPTION = 'Описание не найдено.'
 
 async def download_content(session, url):
     async with session.get(url) as response:
@@ -18,6 +28,129 @@ async def download_content(session, url):
         #print('downloaded', url)
         return await response.text()
 
+async def download_content_with_revision(session, url):
+    """Скачивает файл и возвращает его содержимое и ревизию (ETag)"""
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.text(), response.headers.get('ETag', '')
+
+INCLUDE_PATTERN = re.compile(r'\{%\s*include\s+(?:notitle\s+)?\[(.*?)\]\((.*?)\)\s*%\}')
+WIKILINK_PATTERN = re.compile(r'\[\[([^\]|#]+)(?:[#|][^\]]*)?\]\]')
+
+def is_role_include(url):
+    """Include на файл роли - указатель на роль для parse_markdown, а не вставка"""
+    return '/_roles/' in url
+
+async def resolve_includes(session, content, url, skip=None, memo=None):
+    """
+    Рекурсивно подставляет содержимое всех {% include %} в документ
+
+    Все include собираются волнами: каждый уникальный файл скачивается
+    один раз, файлы одной волны - параллельно. Затем документ собирается
+    рекурсивно. Include, образующие цикл или не скачанные, удаляются из
+    текста, иначе parse_markdown принял бы их за указатели на роли.
+
+    Args:
+        session: aiohttp.ClientSession
+        content: текст документа
+        url: адрес документа, относительно него разрешаются пути include
+        skip: функция url -> bool для include, которые не нужно подставлять.
+            Пути в таких include переписываются относительно документа url
+        memo: словарь url -> содержимое, общий для нескольких вызовов
+
+    Returns:
+        str: документ с подставленными include
+    """
+    if memo is None:
+        memo = {}
+    skip = skip or (lambda include_url: False)
+
+    def include_urls(text, base):
+        for match in INCLUDE_PATTERN.finditer(text):
+            include_url = urljoin(base, match.group(2).split('#', 1)[0])
+            if not skip(include_url):
+                yield include_url
+
+    # Скачиваем include волнами, пока находятся новые файлы
+    failed = set()
+    wave = {u for u in include_urls(content, url) if u not in memo}
+    while wave:
+        urls = sorted(wave)
+        results = await asyncio.gather(*(download_content(session, u) for u in urls), return_exceptions=True)
+        downloaded = {}
+        for include_url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                print(f"Не удалось скачать include {include_url}: {result!r}")
+                failed.add(include_url)
+            else:
+                downloaded[include_url] = result
+        memo.update(downloaded)
+        wave = {u for text_url, text in downloaded.items()
+                for u in include_urls(text, text_url) if u not in memo and u not in failed}
+
+    root_dir = posixpath.dirname(url)
+    # Собранные include, в раскрытии которых не встретилось циклов
+    expanded = {}
+    cycles = []
+    reported_cycles = set()
+
+    def expand(text, base, stack):
+        def replace(match):
+            target = match.group(2)
+            include_url = urljoin(base, target.split('#', 1)[0])
+            if skip(include_url):
+                # Переписываем путь относительно исходного документа
+                relative = posixpath.relpath(urljoin(base, target), root_dir)
+                return match.group(0).replace(f"({target})", f"({relative})")
+            if include_url not in memo:
+                # Include не скачался, сообщение уже выведено
+                return ''
+            if include_url in stack:
+                cycle = tuple(stack[stack.index(include_url):] + [include_url])
+                cycles.append(cycle)
+                if cycle not in reported_cycles:
+                    reported_cycles.add(cycle)
+                    print(f"Циклический include: {' -> '.join(cycle)}")
+                return ''
+            if include_url in expanded:
+                return expanded[include_url]
+            found_cycles = len(cycles)
+            result = expand(memo[include_url], include_url, stack + [include_url])
+            if len(cycles) == found_cycles:
+                expanded[include_url] = result
+            return result
+        return INCLUDE_PATTERN.sub(replace, text)
+
+    return expand(content, url, [url])
+
+def load_fetch_journal(journal_path, revision):
+    """
+    Читает журнал загруженных описаний
+
+    Записи другой ревизии roles-reference.md пропускаются: после изменений
+    в документации описания нужно скачать заново.
+
+    Args:
+        journal_path: путь к журналу
+        revision: ревизия (ETag) roles-reference.md текущего запуска
+
+    Returns:
+        dict: путь роли -> последняя запись журнала этой ревизии
+    """
+    entries = {}
+    if not revision or not os.path.exists(journal_path):
+        return entries
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла не дописаться при обрыве
+                continue
+            if entry.get('revision') == revision:
+                entries[entry['path']] = entry
+    return entries
+
 def load_presets_yaml(yaml_content):
     yaml_dict = yaml.safe_load(yaml_content)
     return yaml_dict
@@ -150,10 +283,45 @@ def parse_markdown(markdown_content, variables):
 
     return roles_tree
 
-async def fetch_role_descriptions(roles_tree, variables, session):
+async def fetch_role_descriptions(roles_tree, variables, session, journal_path=None, resume=False, on_description=None,
+                                  revision=''):
+    """
+    Загружает описания ролей
+
+    Args:
+        roles_tree: дерево ролей из parse_markdown, описания пишутся в него
+        variables: переменные из presets.yaml
+        session: aiohttp.ClientSession
+        journal_path: путь к журналу загрузок, каждая успешная загрузка
+            дописывается в него сразу по получении
+        resume: взять уже загруженные описания из журнала и скачать
+            только недостающие
+        on_description: корутина, которая вызывается для каждой роли
+            сразу после получения ее описания
+        revision: ревизия (ETag) roles-reference.md, ключ записей журнала
+            вместе с путем роли
+
+    Returns:
+        int: число ролей, которые не удалось скачать из-за временных ошибок
+    """
     base_url = 'https://raw.githubusercontent.com/yandex-cloud/docs/refs/heads/master/ru/'
 
+    journal = {}
+    journal_file = None
+    if journal_path:
+        if resume:
+            journal = load_fetch_journal(journal_path, revision)
+        journal_file = open(journal_path, 'a' if resume else 'w', encoding='utf-8')
+
+    failed = 0
+
     async def fetch_description(value):
+        nonlocal failed
+        if value['path'] in journal:
+            value['description'] = journal[value['path']]['description']
+            if on_description:
+                await on_description(value)
+            return
         role_url = base_url + value['path']
         try:
             content = await download_content(session, role_url)
@@ -161,13 +329,26 @@ async def fetch_role_descriptions(roles_tree, variables, session):
             content = replace_variables(content, variables)
             # Extract description (assuming it's the first non-empty paragraph)
             paragraphs = [p.strip() for p in content.strip().split('\n\n') if p.strip()]
-            description = paragraphs[0] if paragraphs else 'Описание не найдено.'
+            description = paragraphs[0] if paragraphs else MISSING_DESCRIPTION
             # Clean markdown formatting
             description = re.sub(r'(.*?)', r'\1', description)
             description = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', description)
-            value['description'] = description
         except Exception as e:
-            value['description'] = 'Описание не найдено.'
+            value['description'] = MISSING_DESCRIPTION
+            # В журнал попадает только отсутствующий файл. Обрыв соединения,
+            # недокачанный ответ, 403/429 и 5xx - временные ошибки, такие роли
+            # будут скачаны при --resume
+            if not isinstance(e, aiohttp.ClientResponseError) or e.status != 404:
+                failed += 1
+                return
+            description = value['description']
+        value['description'] = description
+        if journal_file:
+            entry = {'path': value['path'], 'revision': revision, 'description': description}
+            journal_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            journal_file.flush()
+        if on_description:
+            await on_description(value)
 
     async def recurse(tree):
         tasks = []
@@ -182,7 +363,12 @@ async def fetch_role_descriptions(roles_tree, variables, session):
         if tasks:
             await asyncio.gather(*tasks)
 
-    await recurse(roles_tree)
+    try:
+        await recurse(roles_tree)
+    finally:
+        if journal_file:
+            journal_file.close()
+    return failed
 
 
 def generate_mermaid_mindmap(roles_tree):
@@ -218,6 +404,29 @@ def generate_mermaid_mindmap(roles_tree):
     recurse(roles_tree)
     return '\n'.join(graph_lines)
 
+def generate_paths(role_name):
+    """Возвращает пути заметок категорий роли и путь заметки самой роли"""
+    parts = role_name.split('.')
+    
+    # Создаем список для хранения путей категорий и роли
+    category_paths = []
+    
+    # Генерируем пути для категорий
+    for i in range(1, len(parts)):
+        current_name = '.'.join(parts[:i])
+        path_parts = ['.'.join(parts[:j]) for j in range(1, i)]
+        role_path = '/'.join(path_parts) if path_parts else ''
+        full_path = f"_categories/{role_path}/{current_name}.md" if role_path else f"_categories/{current_name}.md"
+        category_paths.append((current_name, full_path))
+    
+    # Генерируем путь для самой роли
+    i = len(parts)
+    current_name = '.'.join(parts[:i])
+    path_parts = ['.'.join(parts[:j]) for j in range(1, i)]
+    role_path = '/'.join(path_parts) if path_parts else ''
+    role_full_path = f"_roles/{role_path}/{current_name}.md" if role_path else f"_roles/{current_name}.md"
+    return category_paths, role_full_path
+
 def create_obsidian_vault(json_data, output_dir):
     # def create_markdown_file(path, content, parent=None, children=None):
     #     # Создаем директории, если они не существуют
@@ -244,30 +453,6 @@ def create_obsidian_vault(json_data, output_dir):
     #             for link in links:
     #                 f.write(f"- [[{link}]]\n")
 
-    def generate_paths(role_name, service_name, root='roles'):
-        paths = []
-        parts = role_name.split('.')
-        
-        # Создаем список для хранения путей категорий и роли
-        category_paths = []
-        
-        # Генерируем пути для категорий
-        for i in range(1, len(parts)):
-            current_name = '.'.join(parts[:i])
-            path_parts = ['.'.join(parts[:j]) for j in range(1, i)]
-            role_path = '/'.join(path_parts) if path_parts else ''
-            full_path = f"_categories/{role_path}/{current_name}.md" if role_path else f"_categories/{current_name}.md"
-            category_paths.append((current_name, full_path))
-        
-        # Генерируем путь для самой роли
-        i = len(parts)
-        current_name = '.'.join(parts[:i])
-        path_parts = ['.'.join(parts[:j]) for j in range(1, i)]
-        role_path = '/'.join(path_parts) if path_parts else ''
-        role_full_path = f"_roles/{role_path}/{current_name}.md" if role_path else f"_roles/{current_name}.md"
-        return category_paths, role_full_path
-
-
     def create_markdown_file(path, content, parent=None, children=None):
         # Создаем директории, если они не существуют
         os.makedirs(os.path.dirname(os.path.join(output_dir, path)), exist_ok=True)
@@ -313,7 +498,7 @@ def create_obsidian_vault(json_data, output_dir):
         # Первый проход: собираем информацию о детях
         for key, value in data.items():
             if isinstance(value, dict) and "description" in value:
-                category_paths, role_path = generate_paths(key, parent_name)
+                category_paths, role_path = generate_paths(key)
                 
                 # Собираем детей для каждой категории
                 for i, (cat_name, _) in enumerate(category_paths):
@@ -328,7 +513,7 @@ def create_obsidian_vault(json_data, output_dir):
         for key, value in data.items():
             if isinstance(value, dict):
                 if "description" in value:
-                    category_paths, role_path = generate_paths(key, parent_name)
+                    category_paths, role_path = generate_paths(key)
                     value["path"] = role_path
                     
                     # Создаем файлы категорий
@@ -465,7 +650,7 @@ def update_categories_links(vault_dir):
                     roles.add(role_name)
         else:
             # Для остальных категорий
-            base_path = base_path.replace('.md', '')
+            base_path = base_path.removesuffix('.md')
             
             # Ищем категории-потомки
             for child_category in categories_dir.rglob("*.md"):
@@ -537,6 +722,372 @@ def update_categories_links(vault_dir):
             update_category_file(category_file)
 
 
+async def stream_obsidian_vault(roles_tree, variables, session, output_dir, journal_path=None, resume=False,
+                                revision=''):
+    """
+    Скачивает описания ролей и сразу пишет заметки хранилища
+
+    Заметка роли записывается, как только получено ее описание. Заметки
+    категорий и ROLES.md строятся по дереву ролей, без повторного чтения
+    диска, как в update_categories_links. Запись на диск идет в потоках,
+    параллельно с загрузкой. Хранилище собирается во временной директории
+    и заменяет output_dir, только если все описания скачаны.
+
+    Args:
+        roles_tree: дерево ролей из parse_markdown
+        variables: переменные из presets.yaml
+        session: aiohttp.ClientSession
+        output_dir: путь к директории хранилища
+        journal_path: путь к журналу загрузок, см. fetch_role_descriptions
+        resume: скачать только описания, которых нет в журнале
+        revision: ревизия roles-reference.md для журнала
+
+    Returns:
+        int: число ролей, которые не удалось скачать из-за временных ошибок
+    """
+    partial_dir = f"{output_dir}.partial"
+
+    # Роли в порядке обхода create_obsidian_vault, одноименная роль заменяет предыдущую
+    roles = {}
+
+    def collect_roles(tree):
+        for key, value in tree.items():
+            if isinstance(value, dict):
+                if "description" in value:
+                    roles[key] = value
+                collect_roles(value)
+
+    collect_roles(roles_tree)
+    role_names = {id(value): name for name, value in roles.items()}
+
+    # Структура категорий известна до загрузки описаний
+    categories = {}
+    subcategories = {'ROLES': set()}
+    child_roles = {'ROLES': set()}
+    role_notes = {}
+    for name in roles:
+        category_paths, role_path = generate_paths(name)
+        parent = 'ROLES'
+        for cat_name, cat_path in category_paths:
+            categories[cat_name] = (cat_path, parent)
+            subcategories.setdefault(parent, set()).add(cat_name)
+            parent = cat_name
+        child_roles.setdefault(parent, set()).add(name)
+        role_notes[name] = (role_path, parent)
+
+    def write_note(path, content):
+        full_path = os.path.join(partial_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def render_links(title, names):
+        content = f"###### {title}\n"
+        for link in sorted(names):
+            content += f"- [[{link}]]\n"
+        return content
+
+    def render_root():
+        content = "# ROLES\n\n"
+        content += "Корневая категория для всех ролей\n\n"
+        if subcategories['ROLES'] or child_roles['ROLES']:
+            content += "\n#### Дети\n"
+        if subcategories['ROLES']:
+            content += "\n" + render_links("Подкатегории", subcategories['ROLES'])
+        if child_roles['ROLES']:
+            content += "\n" + render_links("Роли", child_roles['ROLES'])
+        return content
+
+    def render_category(name, parent):
+        content = f"# Категория\n\n{name}\n\n"
+        content += "\n#### Родители\n\n"
+        content += f"- [[{parent}]]\n"
+        if subcategories.get(name) or child_roles.get(name):
+            content += "\n\n#### Дети\n\n"
+        if subcategories.get(name):
+            content += render_links("Подкатегории", subcategories[name])
+        if child_roles.get(name):
+            content += render_links("Роли", child_roles[name])
+        return content
+
+    async def write_role(value):
+        name = role_names.get(id(value))
+        if name is None:
+            return
+        role_path, parent = role_notes[name]
+        content = f"# Роль\n\n{value['description']}\n\n"
+        content += "\n#### Родители\n\n"
+        content += f"- [[{parent}]]\n"
+        await asyncio.to_thread(write_note, role_path, content)
+
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir, exist_ok=True)
+
+    # Заметки категорий пишутся параллельно с загрузкой описаний
+    category_writes = asyncio.gather(
+        asyncio.to_thread(write_note, "_categories/ROLES.md", render_root()),
+        *(asyncio.to_thread(write_note, cat_path, render_category(cat_name, parent))
+          for cat_name, (cat_path, parent) in categories.items()),
+    )
+    try:
+        failed = await fetch_role_descriptions(roles_tree, variables, session, journal_path, resume,
+                                               on_description=write_role, revision=revision)
+    finally:
+        await category_writes
+
+    if failed:
+        # Не трогаем существующее хранилище, пока не скачаны все описания
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        return failed
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(partial_dir, output_dir)
+    return 0
+
+
+def add_similar_roles_links(vault_dir, top_k=5, min_similarity=0.2, ngram_sizes=(3, 4, 5), max_df=50):
+    """
+    Добавляет в заметки ролей раздел "Похожие роли"
+
+    Описания ролей векторизуются как TF-IDF по символьным n-граммам.
+    n-граммы хешируются векторизованно в NumPy, без словаря и циклов по
+    тексту. Слишком частые n-граммы (шаблонные фразы вроде "позволяет
+    просматривать") отбрасываются. Ближайшие соседи ищутся блоками строк:
+    одно умножение разреженных матриц на блок и сортировка его ненулевых
+    элементов, без попарных циклов в Python.
+
+    Args:
+        vault_dir: путь к корневой директории хранилища
+        top_k: максимальное число похожих ролей
+        min_similarity: минимальное косинусное сходство описаний
+        ngram_sizes: длины символьных n-грамм
+        max_df: максимальное число описаний, в которых встречается n-грамма.
+            Ограничивает число кандидатов в соседи, а с ним и время поиска
+    """
+    roles_dir = Path(vault_dir) / "_roles"
+    section = "\n#### Похожие роли\n"
+
+    # Читаем заметки ролей, убирая раздел от предыдущего запуска
+    notes = {}
+    for role_file in sorted(roles_dir.rglob("*.md")):
+        with open(role_file, 'r', encoding='utf-8') as f:
+            notes[role_file] = f.read().split(section, 1)[0]
+    if len(notes) < 2:
+        return
+
+    role_files = list(notes)
+    names = [role_file.stem for role_file in role_files]
+    descriptions = []
+    for content in notes.values():
+        header = content.split("\n####", 1)[0].split("\n")[1:]
+        description = ' '.join(line.strip() for line in header if line.strip())
+        # Заглушки одинаковы у всех ненайденных ролей и не участвуют в поиске:
+        # пустое описание дает нулевой вектор и заметку без раздела
+        descriptions.append('' if description == MISSING_DESCRIPTION else description.lower())
+
+    # Все описания в одном массиве кодов символов, разделитель принадлежит документу -1
+    n_docs = len(descriptions)
+    n_features = 1 << 20
+    codes = np.frombuffer('\x00'.join(descriptions).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    lengths = np.array([len(d) for d in descriptions])
+    doc_ids = np.repeat(np.arange(n_docs), lengths + 1)[:len(codes)]
+    doc_ids[np.cumsum(lengths + 1)[:-1] - 1] = -1
+
+    rows, cols = [], []
+    for n in ngram_sizes:
+        if len(codes) < n:
+            continue
+        windows = len(codes) - n + 1
+        hashes = np.zeros(windows, dtype=np.uint64)
+        for offset in range(n):
+            hashes = hashes * np.uint64(1000003) + codes[offset:offset + windows]
+        # n-грамма целиком внутри одного документа
+        valid = (doc_ids[:windows] >= 0) & (doc_ids[:windows] == doc_ids[n - 1:])
+        rows.append(doc_ids[:windows][valid])
+        cols.append((hashes[valid] % np.uint64(n_features)).astype(np.int64))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    tfidf = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n_docs, n_features))
+    tfidf.sum_duplicates()
+    tfidf.data = np.log1p(tfidf.data)
+
+    # IDF и отбрасывание шаблонных n-грамм
+    df = np.bincount(tfidf.indices, minlength=n_features)
+    idf = np.log((1 + n_docs) / (1 + df)).astype(np.float32) + 1
+    idf[df > max_df] = 0
+    tfidf.data *= idf[tfidf.indices]
+    tfidf.eliminate_zeros()
+
+    # Нормируем строки для косинусного сходства
+    row_ids = np.repeat(np.arange(n_docs), np.diff(tfidf.indptr))
+    norms = np.sqrt(np.bincount(row_ids, weights=tfidf.data ** 2, minlength=n_docs)).astype(np.float32)
+    tfidf.data /= norms[row_ids]
+    tfidf_t = tfidf.T.tocsr()
+
+    # Сходства считаются блоками строк, top-k выбирается по разреженному результату
+    block_size = 2048
+    similar_rows, similar_cols = [], []
+    for start in range(0, n_docs, block_size):
+        similarity = (tfidf[start:start + block_size] @ tfidf_t).tocoo()
+        row = similarity.row.astype(np.int64) + start
+        keep = (row != similarity.col) & (similarity.data >= min_similarity)
+        row, col, score = row[keep], similarity.col[keep], similarity.data[keep]
+        order = np.lexsort((-score, row))
+        row, col = row[order], col[order]
+        rank = np.arange(len(row)) - np.searchsorted(row, row)
+        similar_rows.append(row[rank < top_k])
+        similar_cols.append(col[rank < top_k])
+    similar_rows = np.concatenate(similar_rows)
+    similar_cols = np.concatenate(similar_cols)
+    bounds = np.searchsorted(similar_rows, np.arange(n_docs + 1))
+
+    for i, role_file in enumerate(role_files):
+        similar = [names[j] for j in similar_cols[bounds[i]:bounds[i + 1]] if names[j] != names[i]]
+        content = notes[role_file]
+        if similar:
+            content += section + "\n"
+            for name in similar:
+                content += f"- [[{name}]]\n"
+        with open(role_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+
+def iter_note_links(note_path):
+    """
+    Возвращает пары (раздел, цель) для каждой wiki-link заметки
+
+    Раздел - заголовок "#### " над ссылкой, например "Родители" или
+    "Похожие роли"; для ссылок до первого заголовка - None.
+    """
+    section = None
+    with open(note_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#### '):
+                section = line[5:].strip()
+                continue
+            for target in WIKILINK_PATTERN.findall(line):
+                yield section, target.strip()
+
+
+def validate_vault_links(vault_dir):
+    """
+    Проверяет целостность wiki-links в хранилище за один проход
+
+    Сначала строится индекс имен заметок, затем каждая заметка читается
+    ровно один раз. Поиск циклов по связям "Родители" - итеративный DFS,
+    поэтому общая сложность линейна по числу заметок и ссылок.
+
+    Args:
+        vault_dir: путь к корневой директории хранилища
+
+    Returns:
+        dict со списками: duplicates (одинаковые имена заметок),
+        dangling (ссылки на несуществующие заметки), repeated (повторные
+        ссылки внутри одной заметки), orphans (заметки без входящих ссылок)
+        и cycles (циклы по родителям)
+    """
+    vault_path = Path(vault_dir)
+
+    # Индекс имен: имя заметки -> пути файлов
+    index = {}
+    for note_path in vault_path.rglob("*.md"):
+        if '.obsidian' in note_path.parts:
+            continue
+        index.setdefault(note_path.stem, []).append(note_path)
+
+    report = {
+        'duplicates': sorted(
+            (name, sorted(str(p.relative_to(vault_path)) for p in paths))
+            for name, paths in index.items() if len(paths) > 1
+        ),
+        'dangling': [],
+        'repeated': [],
+        'orphans': [],
+        'cycles': [],
+    }
+
+    incoming = set()
+    parents = {}
+
+    for name, paths in index.items():
+        for note_path in paths:
+            relative = str(note_path.relative_to(vault_path))
+            seen = set()
+            for section, target in iter_note_links(note_path):
+                if target in seen:
+                    report['repeated'].append((relative, target))
+                    continue
+                seen.add(target)
+                if target not in index:
+                    report['dangling'].append((relative, target))
+                    continue
+                # Похожие роли не связывают заметку с иерархией
+                if section != 'Похожие роли':
+                    incoming.add(target)
+                if section == 'Родители':
+                    parents.setdefault(name, []).append(target)
+
+    # Корень ROLES ни на кого не ссылается и может не иметь входящих ссылок
+    report['orphans'] = sorted(name for name in index if name not in incoming and name != 'ROLES')
+
+    # Поиск циклов: 0 - не посещена, 1 - в стеке обхода, 2 - обработана
+    state = {}
+    for start in parents:
+        if state.get(start):
+            continue
+        stack = [(start, iter(parents.get(start, ())))]
+        path = [start]
+        state[start] = 1
+        while stack:
+            node, targets = stack[-1]
+            for target in targets:
+                target_state = state.get(target, 0)
+                if target_state == 1:
+                    report['cycles'].append(path[path.index(target):] + [target])
+                elif target_state == 0:
+                    state[target] = 1
+                    stack.append((target, iter(parents.get(target, ()))))
+                    path.append(target)
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+                path.pop()
+
+    report['dangling'].sort()
+    report['repeated'].sort()
+    return report
+
+
+def print_validation_report(report):
+    """Печатает отчет validate_vault_links, возвращает True если ошибок нет"""
+    titles = {
+        'duplicates': 'Заметки с одинаковыми именами',
+        'dangling': 'Ссылки на несуществующие заметки',
+        'repeated': 'Повторные ссылки в заметке',
+        'orphans': 'Заметки без входящих ссылок',
+        'cycles': 'Циклы по родителям',
+    }
+    ok = True
+    for key, title in titles.items():
+        items = report[key]
+        if not items:
+            continue
+        ok = False
+        print(f"{title}: {len(items)}")
+        for item in items:
+            if key == 'duplicates':
+                print(f"  {item[0]}: {', '.join(item[1])}")
+            elif key in ('dangling', 'repeated'):
+                print(f"  {item[0]} -> [[{item[1]}]]")
+            elif key == 'cycles':
+                print(f"  {' -> '.join(item)}")
+            else:
+                print(f"  {item}")
+    return ok
+
+
 def set_random_colors_for_services(vault_dir):
     """
     Устанавливает случайные цвета для сервисов в графе Obsidian
@@ -740,29 +1291,309 @@ def set_random_colors_for_services(vault_dir):
         json.dump(graph_config, f, indent=2)
 
 
-async def main():
+def export_canvas_layout(vault_dir, canvas_name="ROLES.canvas", iterations=300, seed=0, cell_capacity=16,
+                         overlap_iterations=1000):
+    """
+    Заранее рассчитывает раскладку графа ролей и сохраняет ее как Obsidian Canvas
+
+    Раскладка - векторизованный алгоритм Фрюхтермана-Рейнгольда с сеточным
+    отталкиванием в радиусе cutoff, как в Барнсе-Хате: узлы из ближних 3x3
+    ячеек отталкиваются попарно, а ячейка, в которой больше cell_capacity
+    узлов, и все дальние ячейки действуют как один узел в своем центре масс.
+    Поэтому на узел приходится не больше 9 * cell_capacity попарных
+    взаимодействий и итерация стоит O(N * cell_capacity + E) при любой
+    плотности, в том числе для плотных "звезд" сервис - роли. Оптимальное
+    расстояние задается размером карточки, а после симуляции перекрытые
+    карточки разводятся короткими проходами по той же сетке. Цвета
+    берутся из graph.json, созданного set_random_colors_for_services.
+
+    Args:
+        vault_dir: путь к корневой директории хранилища
+        canvas_name: имя создаваемого .canvas файла в корне хранилища
+        iterations: число итераций симуляции
+        seed: зерно для начального расположения узлов
+        cell_capacity: число узлов в ячейке, после которого она заменяется
+            центром масс
+        overlap_iterations: наибольшее число проходов разведения карточек
+    """
+    vault_path = Path(vault_dir)
+
+    # Узлы - заметки категорий и ролей, ребра - связи "Родители"
+    files = {}
+    for folder in ("_categories", "_roles"):
+        for note_path in sorted((vault_path / folder).rglob("*.md")):
+            files.setdefault(note_path.stem, note_path.relative_to(vault_path).as_posix())
+    names = list(files)
+    node_ids = {name: i for i, name in enumerate(names)}
+
+    edges = []
+    for name, relative in files.items():
+        for section, target in iter_note_links(vault_path / relative):
+            if section == 'Родители' and target in node_ids:
+                edges.append((node_ids[name], node_ids[target]))
+
+    n = len(names)
+    if not n:
+        return
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+
+    # Карточки заметок на canvas и зазор между ними
+    node_width, node_height, node_gap = 250, 60, 20
+
+    # Оптимальное расстояние между узлами - диагональ карточки с зазором,
+    # и радиус отталкивания
+    k = float(np.hypot(node_width, node_height) + node_gap)
+    cutoff = 2 * k
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(-1, 1, size=(n, 2)) * k * np.sqrt(n)
+    temperature = k * np.sqrt(n) / 10
+    cooling = temperature / (iterations + 1)
+
+    # Половина соседних ячеек: каждая пара узлов рассматривается один раз
+    half_offsets = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+    def repel(delta, radius, mass=1.0):
+        """Сила отталкивания k^2 / d в пределах radius, умноженная на delta / d"""
+        dist = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01)
+        force = np.where(dist < radius, mass * k * k / dist, 0.0) / dist
+        return delta * force[:, None]
+
+    def build_grid(points, cell_size):
+        """Раскладывает узлы по ячейкам сетки"""
+        cells = np.floor(points / cell_size).astype(np.int64)
+        # Запас в 4 ячейки, чтобы смещения соседей не переходили на другой столбец
+        cells -= cells.min(axis=0) - 4
+        width = cells[:, 1].max() + 5
+        keys = cells[:, 0] * width + cells[:, 1]
+        order = np.argsort(keys, kind='stable')
+        unique_keys, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        # Таблица ключ ячейки -> номер занятой ячейки или -1 вместо поиска по ключам
+        table = np.full((cells[:, 0].max() + 5) * width, -1, dtype=np.int64)
+        table[unique_keys] = np.arange(len(unique_keys))
+        return {
+            'keys': keys, 'width': width, 'order': order, 'unique_keys': unique_keys,
+            'starts': starts, 'counts': counts, 'own': table[keys], 'table': table,
+        }
+
+    def neighbor_slots(grid, dx, dy, keys=None):
+        keys = grid['keys'] if keys is None else keys
+        slot = grid['table'][keys + dx * grid['width'] + dy]
+        return slot, slot >= 0
+
+    def cell_pairs(grid, allowed=None):
+        """Пары узлов из соседних ячеек, каждая один раз; allowed(slot) отбирает узлы"""
+        order, starts, counts = grid['order'], grid['starts'], grid['counts']
+        for dx, dy in half_offsets:
+            slot, found = neighbor_slots(grid, dx, dy)
+            if allowed is not None:
+                found &= allowed(slot)
+            src = np.nonzero(found)[0]
+            if not len(src):
+                continue
+            pair_counts = counts[slot[src]]
+            total = pair_counts.sum()
+            first = np.repeat(src, pair_counts)
+            inner = np.arange(total) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+            second = order[np.repeat(starts[slot[src]], pair_counts) + inner]
+
+            if dx == 0 and dy == 0:
+                mask = first < second
+                first, second = first[mask], second[mask]
+            yield first, second
+
+    def apply_pairs(first, second, push):
+        """Прибавляет push к first и вычитает из second"""
+        for axis in (0, 1):
+            disp[:, axis] += np.bincount(first, weights=push[:, axis], minlength=n)
+            disp[:, axis] -= np.bincount(second, weights=push[:, axis], minlength=n)
+
+    def pair_repulsion(grid, allowed, radius):
+        """Попарное отталкивание узлов соседних ячеек, allowed(slot) отбирает узлы"""
+        for first, second in cell_pairs(grid, allowed):
+            apply_pairs(first, second, repel(pos[first] - pos[second], radius))
+
+    def centroid_repulsion(grid, sums, offsets, allowed, radius):
+        """Отталкивание от центров масс соседних ячеек, allowed(slot) отбирает узлы"""
+        counts, own = grid['counts'], grid['own']
+        for dx, dy in offsets:
+            slot, found = neighbor_slots(grid, dx, dy)
+            src = np.nonzero(found & allowed(slot))[0]
+            if not len(src):
+                continue
+            target = slot[src]
+            is_own = (target == own[src]).astype(np.float64)
+            mass = counts[target] - is_own
+            valid = mass > 0
+            src, target, is_own, mass = src[valid], target[valid], is_own[valid], mass[valid]
+            center = (sums[target] - pos[src] * is_own[:, None]) / mass[:, None]
+            disp[src] += repel(pos[src] - center, radius, mass)
+
+    # Ячейки в радиусе cutoff: ближние 3x3 - попарно, остальные - центрами масс
+    cell_size = cutoff / 4
+    near_offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+    far_offsets = [(dx, dy) for dx in range(-4, 5) for dy in range(-4, 5)
+                   if (dx, dy) not in near_offsets]
+
+    for _ in range(iterations):
+        disp = np.zeros((n, 2))
+
+        grid = build_grid(pos, cell_size)
+        unique_keys, counts, own = grid['unique_keys'], grid['counts'], grid['own']
+        dense = counts > cell_capacity
+        sums = np.stack([np.bincount(own, weights=pos[:, axis], minlength=len(unique_keys))
+                         for axis in (0, 1)], axis=1)
+
+        # Ближние разреженные ячейки - попарно, ближние плотные - центрами масс
+        pair_repulsion(grid, lambda slot: ~dense[own] & ~dense[slot], cutoff)
+        centroid_repulsion(grid, sums, near_offsets, lambda slot: dense[own] | dense[slot], cutoff)
+
+        # Дальние ячейки - центр масс на центр масс, сила одна на все узлы ячейки
+        centers = sums / counts[:, None]
+        cell_disp = np.zeros_like(centers)
+        for dx, dy in far_offsets:
+            slot, found = neighbor_slots(grid, dx, dy, unique_keys)
+            src = np.nonzero(found)[0]
+            target = slot[src]
+            cell_disp[src] += repel(centers[src] - centers[target], cutoff, counts[target])
+        disp += cell_disp[own]
+
+        # Притяжение вдоль связей
+        if len(edges):
+            delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+            dist = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01)
+            apply_pairs(edges[:, 0], edges[:, 1], -delta * (dist / k)[:, None])
+
+        # Смещение ограничено текущей температурой
+        length = np.maximum(np.hypot(disp[:, 0], disp[:, 1]), 0.01)
+        pos += disp / length[:, None] * np.minimum(length, temperature)[:, None]
+        temperature -= cooling
+
+    # Симуляция считает узлы точками, а на canvas это карточки. Переходим в
+    # единицы карточки с зазором: карточки i и j перекрываются, если
+    # |x_i - x_j| < 1 и |y_i - y_j| < 1
+    card = np.array([node_width + node_gap, node_height + node_gap], dtype=np.float64)
+    pos = pos / card
+    # Размер самой карточки без зазора: пересечение меньше этого - перекрытие
+    card_size = np.array([node_width, node_height]) / card
+
+    # Растягиваем раскладку, чтобы самый плотный участок 4x4 карточки был
+    # заполнен не больше чем наполовину - иначе карточкам некуда разойтись
+    _, block_counts = np.unique(np.floor(pos / 4).astype(np.int64), axis=0, return_counts=True)
+    pos *= max(1.0, np.sqrt(block_counts.max() / 8))
+
+    # Разводим карточки по оси меньшего перекрытия, пока хотя бы две
+    # карточки перекрываются без учета зазора
+    overlaps = 0
+    for _ in range(overlap_iterations):
+        disp = np.zeros((n, 2))
+        grid = build_grid(pos, 1.0)
+        overlaps = 0
+        for first, second in cell_pairs(grid):
+            delta = pos[first] - pos[second]
+            overlap = 1 - np.abs(delta)
+            hit = (overlap > 0).all(axis=1)
+            if not hit.any():
+                continue
+            first, second, delta, overlap = first[hit], second[hit], delta[hit], overlap[hit]
+            overlaps += (np.abs(delta) < card_size).all(axis=1).sum()
+            rows = np.arange(len(first))
+            axis = np.argmin(overlap, axis=1)
+            push = np.zeros_like(delta)
+            sign = np.where(delta[rows, axis] >= 0, 1.0, -1.0)
+            push[rows, axis] = sign * (overlap[rows, axis] + 0.01) / 2
+            apply_pairs(first, second, push)
+        if not overlaps:
+            break
+        pos += disp
+    if overlaps:
+        print(f"{canvas_name}: перекрываются {overlaps} пар карточек")
+    pos *= card
+
+    # Цвета сервисов из конфигурации графа
+    colors = {}
+    graph_config = vault_path / ".obsidian" / "graph.json"
+    if graph_config.exists():
+        with open(graph_config, 'r', encoding='utf-8') as f:
+            for group in json.load(f).get("colorGroups", []):
+                query = group.get("query", "")
+                if not query.startswith("path:"):
+                    continue
+                rgb = group["color"]["rgb"]
+                rgb = f"#{rgb:06X}" if isinstance(rgb, int) else f"#{rgb}"
+                colors[query[len("path:"):]] = rgb
+
+    pos -= pos.min(axis=0)
+    canvas = {"nodes": [], "edges": []}
+    for i, name in enumerate(names):
+        relative = files[name]
+        folder = relative.split('/', 1)[0]
+        node = {
+            "id": f"node-{i}",
+            "type": "file",
+            "file": relative,
+            "x": int(pos[i, 0]),
+            "y": int(pos[i, 1]),
+            "width": node_width,
+            "height": node_height,
+        }
+        color = colors.get(f"{folder}/{name.split('.')[0]}")
+        if name == "ROLES":
+            color = "#FFFFFF"
+        if color:
+            node["color"] = color
+        canvas["nodes"].append(node)
+
+    for i, (child, parent) in enumerate(edges.tolist()):
+        canvas["edges"].append({
+            "id": f"edge-{i}",
+            "fromNode": f"node-{parent}",
+            "toNode": f"node-{child}",
+        })
+
+    with open(vault_path / canvas_name, 'w', encoding='utf-8') as f:
+        json.dump(canvas, f, ensure_ascii=False)
+
+
+async def main(resume=False, stream=False):
     async with aiohttp.ClientSession() as session:
         # Step 1: Download roles-reference.md and presets.yaml
-        markdown_content, presets_yaml_content, primitive = await asyncio.gather(
-            download_content(session, ROLES_REFERENCE_URL),
+        (markdown_content, revision), presets_yaml_content = await asyncio.gather(
+            download_content_with_revision(session, ROLES_REFERENCE_URL),
             download_content(session, PRESETS_YAML_URL),
-            download_content(session, ROLES_PRIMITIVE),
         )
         variables = load_presets_yaml(presets_yaml_content)
-        
-        markdown_content = markdown_content.replace("{% include [roles-primitive](../_includes/roles-primitive.md) %}", primitive)
+
+        # Подставляем все include, кроме указателей на роли
+        markdown_content = await resolve_includes(session, markdown_content, ROLES_REFERENCE_URL, skip=is_role_include)
 
         # Step 2: Parse markdown to build roles tree
         roles_tree = parse_markdown(markdown_content, variables)
 
         # Step 3: Fetch role descriptions asynchronously
-        await fetch_role_descriptions(roles_tree, variables, session)
-
-        print("==\n==\n==\n", json.dumps(roles_tree, sort_keys=True, indent=4, ensure_ascii=False), "\n==\n==\n==")
-
-        create_obsidian_vault(roles_tree, "yc-obs-roles")
-        update_categories_links("yc-obs-roles")
+        if stream:
+            # Заметки пишутся по мере загрузки описаний
+            failed = await stream_obsidian_vault(roles_tree, variables, session, "yc-obs-roles", FETCH_JOURNAL, resume,
+                                                 revision=revision)
+        else:
+            failed = await fetch_role_descriptions(roles_tree, variables, session, FETCH_JOURNAL, resume,
+                                                   revision=revision)
+        if failed:
+            # Не трогаем существующее хранилище, пока не скачаны все описания
+            print(f"Не удалось скачать описания ролей: {failed}. Повторите запуск с --resume")
+            raise SystemExit(1)
+
+        if not stream:
+            print("==\n==\n==\n", json.dumps(roles_tree, sort_keys=True, indent=4, ensure_ascii=False), "\n==\n==\n==")
+
+            create_obsidian_vault(roles_tree, "yc-obs-roles")
+            update_categories_links("yc-obs-roles")
+        add_similar_roles_links("yc-obs-roles")
         set_random_colors_for_services("yc-obs-roles")
+        export_canvas_layout("yc-obs-roles")
+
+        # Проверяем ссылки в сгенерированном хранилище
+        if not print_validation_report(validate_vault_links("yc-obs-roles")):
+            raise SystemExit(1)
         # Step 4: Generate Mermaid graph
         #mermaid_graph = generate_mermaid_mindmap(roles_tree)
 
@@ -776,4 +1607,11 @@ async def main():
         #print("\nMermaid graph saved to roles_graph.mmd")
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Генерация Obsidian хранилища ролей IAM Yandex Cloud')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'скачать только описания, которых нет в журнале {FETCH_JOURNAL}')
+    parser.add_argument('--stream', action='store_true',
+                        help='писать заметки ролей по мере загрузки описаний')
+    args = parser.parse_args()
+
+    asyncio.run(main(resume=args.resume, stream=args.stream))
\ No newline at end of file